@@ -3,22 +3,140 @@ Endpoint handlers.
 
 Main application module
 """
+import base64
+import decimal
+import functools
+import importlib
+import json
 import logging
+import os
+import queue
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
-import boto3
-import pandas as pd
-from boto3.dynamodb.conditions import Attr, Key
-from flask import Flask, jsonify, request
+from flask import Flask, Response, current_app, jsonify, request
 from flask.views import MethodView
 
-DYNAMO_RESOURCE = boto3.resource(
-    service_name='dynamodb',
-    region_name='ap-southeast-2',
-    endpoint_url='http://dynamodb-local:8000'
-)
-DDB_TABLE = DYNAMO_RESOURCE.Table('PandoraDetails')
-app = Flask(__name__)
+DEFAULT_CONFIG = {
+    'DYNAMO_REGION': 'ap-southeast-2',
+    'DYNAMO_ENDPOINT': 'http://dynamodb-local:8000',
+    'DYNAMO_TABLE_NAME': 'PandoraDetails',
+    # Pre-built table object, set this to inject storage (e.g. in tests)
+    'DDB_TABLE': None,
+    # Import heavy modules while building the app, meant for servers
+    # that load the app once before forking workers
+    'PRELOAD': False,
+    # Parallel scan segments used by the export when none are requested
+    'EXPORT_SEGMENTS': 4,
+    'EXPORT_MAX_SEGMENTS': 16,
+    # Scan threads shared by all exports, every task scans a single page
+    'EXPORT_WORKERS': 8,
+    # Seconds an export waits for its next page before giving up
+    'EXPORT_PAGE_TIMEOUT': 60,
+}
+# Environment variables PANDORA_<KEY> override DEFAULT_CONFIG
+ENV_PREFIX = 'PANDORA_'
+# Modules that are only needed once a request comes in
+HEAVY_MODULES = ('boto3', 'boto3.dynamodb.conditions', 'pandas')
+_TABLE_LOCK = threading.Lock()
+_DYNAMO_RESOURCES = {}
+_THREAD_TABLES = threading.local()
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def config_from_env(environ=None):
+    """
+    Read config values from the environment.
+
+    String settings are taken as is, the others are parsed as JSON,
+    e.g. PANDORA_PRELOAD=true or PANDORA_EXPORT_WORKERS=4.
+    """
+    environ = os.environ if environ is None else environ
+    config = {}
+    for key, default in DEFAULT_CONFIG.items():
+        value = environ.get(ENV_PREFIX + key)
+        if value is None or key == 'DDB_TABLE':
+            continue
+        if isinstance(default, str):
+            config[key] = value
+        else:
+            try:
+                config[key] = json.loads(value)
+            except ValueError as ex:
+                raise ValueError('Invalid value for {}{}: {!r}'.format(
+                    ENV_PREFIX, key, value)) from ex
+    return config
+
+
+def preload():
+    """Import heavy modules ahead of the first request."""
+    for module in HEAVY_MODULES:
+        importlib.import_module(module)
+
+
+def create_table(region, endpoint, table_name):
+    """
+    Create a DynamoDB table resource.
+
+    boto3 resources are not thread-safe so every thread creates its own
+    table. They all come from one service resource per endpoint, whose
+    low-level client is thread-safe, so the costly session is built once.
+    """
+    with _TABLE_LOCK:
+        key = (region, endpoint)
+        if key not in _DYNAMO_RESOURCES:
+            import boto3
+            _DYNAMO_RESOURCES[key] = boto3.session.Session().resource(
+                service_name='dynamodb',
+                region_name=region,
+                endpoint_url=endpoint
+            )
+        return _DYNAMO_RESOURCES[key].Table(table_name)
+
+
+def get_thread_table(region, endpoint, table_name):
+    """Retrieve the calling thread's table, creating it on first use."""
+    tables = _THREAD_TABLES.__dict__.setdefault('tables', {})
+    key = (region, endpoint, table_name)
+    if key not in tables:
+        tables[key] = create_table(region, endpoint, table_name)
+    return tables[key]
+
+
+def get_table():
+    """
+    Retrieve the DynamoDB table for the current app and thread.
+
+    An injected DDB_TABLE is shared as is. Otherwise the table is created
+    on first use so importing the module or building the app does not
+    import boto3 or open any connection.
+    """
+    config = current_app.config
+    if config['DDB_TABLE'] is not None:
+        return config['DDB_TABLE']
+    return get_thread_table(
+        config['DYNAMO_REGION'],
+        config['DYNAMO_ENDPOINT'],
+        config['DYNAMO_TABLE_NAME']
+    )
+
+
+def get_export_executor():
+    """
+    Retrieve the scan thread pool for the current app.
+
+    The pool is created on first use and shared by every export.
+    """
+    extensions = current_app.extensions
+    if 'export_executor' not in extensions:
+        with _EXECUTOR_LOCK:
+            if 'export_executor' not in extensions:
+                extensions['export_executor'] = ThreadPoolExecutor(
+                    max_workers=current_app.config['EXPORT_WORKERS'],
+                    thread_name_prefix='export'
+                )
+    return extensions['export_executor']
 
 
 class CompanyAPI(MethodView):
@@ -30,6 +148,8 @@ class CompanyAPI(MethodView):
 
         Retrieve a company's list of users.
         """
+        from boto3.dynamodb.conditions import Key
+
         payload = {}
         try:
             user_details = [
@@ -38,7 +158,7 @@ class CompanyAPI(MethodView):
             # Retrieve the company
             key_exp = Key('pk').eq('company') & Key(
                 'sk').begins_with(str(company_id))
-            company = DDB_TABLE.query(
+            company = get_table().query(
                 KeyConditionExpression=key_exp
             )
             if company.get('Count', 0) == 0:
@@ -49,7 +169,7 @@ class CompanyAPI(MethodView):
                 # Retrieve users employees the company
                 user_key_exp = Key('pk').eq('person') & Key(
                     'sk').begins_with(str(company_id))
-                users = DDB_TABLE.query(
+                users = get_table().query(
                     KeyConditionExpression=user_key_exp,
                     ProjectionExpression=', '.join(user_details)
                 )
@@ -76,13 +196,15 @@ class UserAPI(MethodView):
 
     def retrieve_user(self, user_id):
         """Retrieve user from table."""
+        from boto3.dynamodb.conditions import Key
+
         pk_exp = Key('pk').eq('person')
 
         for lsi_key in self.lsi_key_combinations:
             sk_exp = Key('lsi').eq(lsi_key + '#' + user_id)
             key_exp = pk_exp & sk_exp
             # Retrieve user with ID
-            user = DDB_TABLE.query(
+            user = get_table().query(
                 IndexName='user-id-index',
                 KeyConditionExpression=key_exp
             )
@@ -92,8 +214,13 @@ class UserAPI(MethodView):
                 return user['Items'][0]
 
     def retrieve_common_friends(
-            self, user_ids, friends=pd.DataFrame(), last_record=None):
+            self, user_ids, friends=None, last_record=None):
         """Retrieve multiple users from the table."""
+        import pandas as pd
+        from boto3.dynamodb.conditions import Attr, Key
+
+        if friends is None:
+            friends = pd.DataFrame()
         key_exp = Key('pk').eq('person') & Key('lsi').begins_with(
             'True#False')
         filters = {
@@ -103,7 +230,7 @@ class UserAPI(MethodView):
         }
         if last_record:
             filters['ExclusiveStartKey'] = last_record
-        users = DDB_TABLE.query(**filters)
+        users = get_table().query(**filters)
         friends = friends.append(users['Items'])
         if users.get('LastEvaluatedKey') is not None:
             self.retrieve_common_friends(
@@ -226,13 +353,212 @@ class UserAPI(MethodView):
         return jsonify(payload), status_code
 
 
-user_api = UserAPI.as_view('users_api')
-company_api = CompanyAPI.as_view('companies')
-app.add_url_rule(
-    '/users/', view_func=user_api,
-    defaults={'user_id': None})
-app.add_url_rule(
-    '/users/<string:user_id>', view_func=user_api)
-app.add_url_rule(
-    '/companies/<int:company_id>',
-    view_func=company_api)
+def encode_cursor(total_segments, pending):
+    """
+    Encode the export position as a resume token.
+
+    pending maps every unfinished segment to the key its scan continues
+    from, None if it has not started yet. Returns None once all segments
+    are done.
+    """
+    if not pending:
+        return None
+    state = {
+        'total': total_segments,
+        'pending': {str(segment): key for segment, key in pending.items()}
+    }
+    return base64.urlsafe_b64encode(
+        json.dumps(state, default=_json_default).encode('utf-8')
+    ).decode('ascii')
+
+
+def decode_cursor(token):
+    """Decode a resume token, raising ValueError if it is invalid."""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token.encode('ascii')))
+        total_segments = int(state['total'])
+        pending = {
+            int(segment): key for segment, key in state['pending'].items()
+        }
+    except (AttributeError, KeyError, TypeError) as ex:
+        raise ValueError('Malformed cursor') from ex
+    if not pending or not all(
+            0 <= segment < total_segments for segment in pending):
+        raise ValueError('Cursor segments out of range')
+    if not all(key is None or isinstance(key, dict)
+               for key in pending.values()):
+        raise ValueError('Cursor start keys must be objects')
+    return total_segments, pending
+
+
+def _json_default(value):
+    """Serialise DynamoDB types that json does not handle."""
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(
+            value)
+    if isinstance(value, set):
+        return sorted(value)
+    raise TypeError('Unserialisable value: {!r}'.format(value))
+
+
+def scan_page(
+        table_factory, segment, total_segments, start_key, pages, stop):
+    """Scan one page of a segment of the people and queue it."""
+    if stop.is_set():
+        return
+    from boto3.dynamodb.conditions import Attr
+
+    filters = {
+        'Segment': segment,
+        'TotalSegments': total_segments,
+        'FilterExpression': Attr('pk').eq('person')
+    }
+    if start_key:
+        filters['ExclusiveStartKey'] = start_key
+    try:
+        result = table_factory().scan(**filters)
+        pages.put((
+            segment, result.get('Items', []),
+            result.get('LastEvaluatedKey'), None
+        ))
+    except Exception as ex:
+        pages.put((segment, [], None, ex))
+
+
+def stream_people(
+        executor, table_factory, total_segments, pending, page_timeout):
+    """
+    Generate people as NDJSON.
+
+    Every task on the executor scans a single page, a segment's next page
+    is only requested once the previous one has been taken for the client.
+    A slow client therefore holds no scan thread and buffers at most one
+    page per segment. Every page of records is followed by a cursor line
+    which resumes the export right after that page.
+    """
+    internal_keys = ('pk', 'sk', 'lsi')
+    pending = dict(pending)
+    pages = queue.Queue()
+    stop = threading.Event()
+
+    def request_page(segment, start_key):
+        executor.submit(
+            scan_page, table_factory, segment, total_segments, start_key,
+            pages, stop
+        )
+
+    try:
+        for segment, start_key in pending.items():
+            request_page(segment, start_key)
+        while pending:
+            try:
+                segment, items, last_key, error = pages.get(
+                    timeout=page_timeout)
+            except queue.Empty:
+                logging.error(
+                    'Export timed out after %s seconds', page_timeout)
+                yield json.dumps({'Error': 'Export timed out'}) + '\n'
+                return
+            if error is not None:
+                logging.error(
+                    'Export failed on segment %s', segment, exc_info=error)
+                yield json.dumps({'Error': 'Unknown error occured'}) + '\n'
+                return
+            if last_key is None:
+                del pending[segment]
+            else:
+                pending[segment] = last_key
+                request_page(segment, last_key)
+            lines = [
+                json.dumps({
+                    k: v for k, v in item.items() if k not in internal_keys
+                }, default=_json_default)
+                for item in items
+            ]
+            lines.append(json.dumps(
+                {'cursor': encode_cursor(total_segments, pending)}))
+            yield '\n'.join(lines) + '\n'
+    finally:
+        # Also runs when the client disconnects mid stream, pages of this
+        # export still waiting for a thread are skipped
+        stop.set()
+
+
+class ExportAPI(MethodView):
+    """Class-based view for the export API."""
+
+    def get(self):
+        """
+        Stream every person.
+
+        People are scanned in parallel segments, the optional query
+        parameter segments sets how many. A cursor from a previous
+        export resumes it instead.
+        """
+        config = current_app.config
+        try:
+            if 'cursor' in request.args:
+                total_segments, pending = decode_cursor(
+                    request.args['cursor'])
+            else:
+                total_segments = int(request.args.get(
+                    'segments', config['EXPORT_SEGMENTS']))
+                pending = dict.fromkeys(range(total_segments))
+            if not 0 < total_segments <= config['EXPORT_MAX_SEGMENTS']:
+                raise ValueError('Segments out of range')
+        except ValueError:
+            payload = {
+                'Error': 'Invalid cursor or segments, segments must be '
+                'between 1 and {}'.format(config['EXPORT_MAX_SEGMENTS'])
+            }
+            return jsonify(payload), 400
+        injected_table = config['DDB_TABLE']
+        if injected_table is not None:
+            # Injected storage is shared as is
+            def table_factory():
+                return injected_table
+        else:
+            table_factory = functools.partial(
+                get_thread_table,
+                config['DYNAMO_REGION'],
+                config['DYNAMO_ENDPOINT'],
+                config['DYNAMO_TABLE_NAME']
+            )
+        return Response(
+            stream_people(
+                get_export_executor(), table_factory, total_segments, pending,
+                config['EXPORT_PAGE_TIMEOUT']
+            ),
+            mimetype='application/x-ndjson'
+        )
+
+
+def create_app(config=None):
+    """
+    Create the application.
+
+    Values in config override the environment, which overrides
+    DEFAULT_CONFIG.
+    """
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config.from_mapping(config_from_env())
+    if config:
+        app.config.from_mapping(config)
+    if app.config['PRELOAD']:
+        preload()
+
+    user_api = UserAPI.as_view('users_api')
+    company_api = CompanyAPI.as_view('companies')
+    export_api = ExportAPI.as_view('export')
+    app.add_url_rule(
+        '/users/', view_func=user_api,
+        defaults={'user_id': None})
+    app.add_url_rule(
+        '/users/<string:user_id>', view_func=user_api)
+    app.add_url_rule(
+        '/companies/<int:company_id>',
+        view_func=company_api)
+    app.add_url_rule(
+        '/export/people.ndjson', view_func=export_api)
+    return app
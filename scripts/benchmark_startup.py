@@ -0,0 +1,116 @@
+"""
+Benchmark worker start up
+
+Every measurement runs in a fresh interpreter so imports are cold. The
+eager mode reproduces the old module level imports and DynamoDB resource
+as a baseline. RSS is read from /proc so this only runs on Linux.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+MEASURE_SCRIPT = '''
+import json
+import os
+import sys
+import time
+
+start = time.perf_counter()
+from app.app import DEFAULT_CONFIG, create_app
+eager_table = None
+if sys.argv[1] == 'eager':
+    # What importing app.app did before the application factory
+    import boto3
+    import pandas
+    from boto3.dynamodb.conditions import Attr, Key
+    eager_table = boto3.resource(
+        service_name='dynamodb',
+        region_name=DEFAULT_CONFIG['DYNAMO_REGION'],
+        endpoint_url=DEFAULT_CONFIG['DYNAMO_ENDPOINT']
+    ).Table(DEFAULT_CONFIG['DYNAMO_TABLE_NAME'])
+import_time = time.perf_counter() - start
+
+
+class EmptyTable(object):
+
+    def query(self, **kwargs):
+        return {'Count': 0}
+
+
+config = {'PRELOAD': sys.argv[1] == 'preload'}
+if sys.argv[2] == 'stub':
+    config['DDB_TABLE'] = EmptyTable()
+else:
+    config['DDB_TABLE'] = eager_table
+start = time.perf_counter()
+app = create_app(config)
+create_time = time.perf_counter() - start
+with app.test_client() as client:
+    start = time.perf_counter()
+    client.get(sys.argv[3])
+    first_response_time = time.perf_counter() - start
+    for _ in range(int(sys.argv[4])):
+        client.get(sys.argv[3])
+with open('/proc/self/statm') as statm:
+    resident_pages = int(statm.read().split()[1])
+print(json.dumps({
+    'import_time': import_time,
+    'create_time': create_time,
+    'first_response_time': first_response_time,
+    'rss_bytes': resident_pages * os.sysconf('SC_PAGE_SIZE'),
+}))
+'''
+
+
+def measure(mode, storage, path, warm_up):
+    """Run one cold start in a new interpreter and return its timings."""
+    output = subprocess.check_output([
+        sys.executable, '-c', MEASURE_SCRIPT,
+        mode, storage, path, str(warm_up)
+    ])
+    return json.loads(output)
+
+
+def summarise(runs):
+    """Return the median of every metric across runs."""
+    summary = {}
+    for key in runs[0]:
+        values = sorted(run[key] for run in runs)
+        summary[key] = values[len(values) // 2]
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure import time, time to first response and RSS.")
+    parser.add_argument(
+        "--runs", type=int, default=5,
+        help="number of cold starts per mode")
+    parser.add_argument(
+        "--path", default='/companies/1',
+        help="endpoint requested after start up")
+    parser.add_argument(
+        "--warm-up", type=int, default=50,
+        help="requests made after the first one before reading RSS")
+    parser.add_argument(
+        "--live", action='store_true',
+        help="query the configured DynamoDB table instead of a stub")
+
+    args = parser.parse_args()
+    storage = 'live' if args.live else 'stub'
+    for mode in ('eager', 'lazy', 'preload'):
+        summary = summarise([
+            measure(mode, storage, args.path, args.warm_up)
+            for _ in range(args.runs)
+        ])
+        print('{} ({} storage, median of {} runs)'.format(
+            mode, storage, args.runs))
+        print('  import:            {:8.1f} ms'.format(
+            summary['import_time'] * 1000))
+        print('  create_app:        {:8.1f} ms'.format(
+            summary['create_time'] * 1000))
+        print('  first response:    {:8.1f} ms'.format(
+            summary['first_response_time'] * 1000))
+        print('  RSS after warm-up: {:8.1f} MB'.format(
+            summary['rss_bytes'] / 1024 / 1024))
@@ -2,9 +2,17 @@
 Test Cases for Pandora API
 """
 import json
+import queue
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 from unittest import TestCase, TestLoader, TextTestRunner, mock
 
-from app.app import app
+from app.app import (
+    create_app, encode_cursor, get_table, scan_page, stream_people
+)
 
 
 class MockEmptyDynamoResource(object):
@@ -96,28 +104,71 @@ class MockUserDynamoResource(MockEmptyDynamoResource):
             return {'Count': 0}
 
 
+class MockScanDynamoResource(MockEmptyDynamoResource):
+    """Two pages of one person each for every segment."""
+
+    def scan(self, **kwargs):
+        segment = kwargs['Segment']
+        page = 1 if 'ExclusiveStartKey' in kwargs else 0
+        result = {
+            'Items': [{
+                'pk': 'person',
+                'sk': '1#{}{}'.format(segment, page),
+                'lsi': 'True#False#user{}{}'.format(segment, page),
+                'user_id': 'user{}{}'.format(segment, page),
+                'age': Decimal(31),
+                'fruits': {'banana', 'apple'},
+                'vegetables': None,
+            }],
+            'Count': 1
+        }
+        if page == 0:
+            result['LastEvaluatedKey'] = {
+                'pk': 'person', 'sk': '1#{}{}'.format(segment, page)}
+        return result
+
+
+class MockEndlessScanDynamoResource(MockEmptyDynamoResource):
+    """Never runs out of pages and counts the scans made."""
+
+    def __init__(self, *args, **kwargs):
+        self.scans = 0
+
+    def scan(self, **kwargs):
+        self.scans += 1
+        return {
+            'Items': [{'pk': 'person', 'user_id': str(self.scans)}],
+            'Count': 1,
+            'LastEvaluatedKey': {'pk': 'person', 'sk': str(self.scans)}
+        }
+
+
+class MockFailingScanDynamoResource(MockEmptyDynamoResource):
+
+    def scan(self, **kwargs):
+        raise Exception('Scan failed')
+
+
 class CompanyAPITestCases(TestCase):
     """Test cases for the Company API."""
     url = '/companies/{}'
 
     def test_company_api_missing_id(self):
         """Test if app returns 404 if company id is not provided."""
-        with app.test_client() as client:
+        with create_app().test_client() as client:
             resp = client.get(self.url.format(''))
             self.assertEqual(resp.status_code, 404)
 
     def test_company_api_invalid_method(self):
         """Test if app returns 405 if company id is not provided."""
-        with app.test_client() as client:
+        with create_app().test_client() as client:
             resp = client.post(self.url.format(1))
             self.assertEqual(resp.status_code, 405)
 
     def test_company_api_company_non_existent(self):
         """Test if app returns 405 if company id is not provided."""
-        with app.test_client() as client, mock.patch(
-            'app.app.DDB_TABLE',
-            MockEmptyDynamoResource()
-        ):
+        app = create_app({'DDB_TABLE': MockEmptyDynamoResource()})
+        with app.test_client() as client:
             resp = client.get(self.url.format(1))
             self.assertEqual(resp.status_code, 404)
             resp_body = resp.json
@@ -129,10 +180,9 @@ class CompanyAPITestCases(TestCase):
 
     def test_company_api_success(self):
         """Test company api successfully returns with data."""
-        with app.test_client() as client, mock.patch(
-            'app.app.DDB_TABLE',
-            MockCompanyDynamoResource()
-        ) as mock_table:
+        mock_table = MockCompanyDynamoResource()
+        app = create_app({'DDB_TABLE': mock_table})
+        with app.test_client() as client:
             resp = client.get(self.url.format(1))
             self.assertEqual(resp.status_code, 200)
             resp_body = resp.json
@@ -159,25 +209,21 @@ class UserAPITestCases(TestCase):
 
     def test_user_api_invalid_method(self):
         """Test user api returns error for unimplemented method."""
-        with app.test_client() as client:
+        with create_app().test_client() as client:
             resp = client.post(self.url.format(1))
             self.assertEqual(resp.status_code, 405)
 
     def test_user_api_user_non_existent(self):
         """Test user api returns error when user is not existing."""
-        with app.test_client() as client, mock.patch(
-            'app.app.DDB_TABLE',
-            MockEmptyDynamoResource()
-        ):
+        app = create_app({'DDB_TABLE': MockEmptyDynamoResource()})
+        with app.test_client() as client:
             resp = client.get(self.url.format('ASDASD'))
             self.assertEqual(resp.status_code, 404)
 
     def test_user_api_user_id_success(self):
         """Test user api successfully returns user details"""
-        with app.test_client() as client, mock.patch(
-            'app.app.DDB_TABLE',
-            MockUserDynamoResource()
-        ):
+        app = create_app({'DDB_TABLE': MockUserDynamoResource()})
+        with app.test_client() as client:
             resp = client.get(self.url.format('123asddv32ef'))
             self.assertEqual(resp.status_code, 200)
             expected_keys = ['username', 'age', 'fruits', 'vegetables']
@@ -186,7 +232,7 @@ class UserAPITestCases(TestCase):
 
     def test_user_api_no_id_no_params(self):
         """Test user api returns error when there's no ID and parameters."""
-        with app.test_client() as client:
+        with create_app().test_client() as client:
             resp = client.get(self.url.format(''))
             self.assertEqual(resp.status_code, 400)
             resp_body = resp.json
@@ -198,7 +244,7 @@ class UserAPITestCases(TestCase):
 
     def test_user_api_no_id_one_key_missing(self):
         """Test user api returns error when only one query parameter exists."""
-        with app.test_client() as client:
+        with create_app().test_client() as client:
             resp = client.get(
                 self.url.format(''),
                 query_string={
@@ -215,10 +261,8 @@ class UserAPITestCases(TestCase):
 
     def test_user_api_no_id_one_user_non_existent(self):
         """Test user api returns error when only one user is existing."""
-        with app.test_client() as client, mock.patch(
-            'app.app.DDB_TABLE',
-            MockUserDynamoResource()
-        ):
+        app = create_app({'DDB_TABLE': MockUserDynamoResource()})
+        with app.test_client() as client:
             resp = client.get(
                 self.url.format(''),
                 query_string={
@@ -236,10 +280,9 @@ class UserAPITestCases(TestCase):
 
     def test_user_api_no_id_success(self):
         """Test user api returns data succesfully using query parameters."""
-        with app.test_client() as client, mock.patch(
-            'app.app.DDB_TABLE',
-            MockUserDynamoResource()
-        ) as mock_table:
+        mock_table = MockUserDynamoResource()
+        app = create_app({'DDB_TABLE': mock_table})
+        with app.test_client() as client:
             resp = client.get(
                 self.url.format(''),
                 query_string={
@@ -273,8 +316,231 @@ class UserAPITestCases(TestCase):
                 )
 
 
+class ExportAPITestCases(TestCase):
+    """Test cases for the Export API."""
+    url = '/export/people.ndjson'
+
+    def read_lines(self, resp):
+        """Parse every NDJSON line of the response."""
+        return [json.loads(line) for line in resp.data.splitlines()]
+
+    def test_export_api_success(self):
+        """Test export api streams every person followed by cursors."""
+        app = create_app({'DDB_TABLE': MockScanDynamoResource()})
+        with app.test_client() as client:
+            resp = client.get(self.url, query_string={'segments': 2})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'application/x-ndjson')
+            lines = self.read_lines(resp)
+            people = [line for line in lines if 'cursor' not in line]
+            self.assertEqual(
+                sorted(person['user_id'] for person in people),
+                ['user00', 'user01', 'user10', 'user11']
+            )
+            for person in people:
+                self.assertNotIn('pk', person)
+                self.assertNotIn('lsi', person)
+                self.assertEqual(person['age'], 31)
+                self.assertEqual(person['fruits'], ['apple', 'banana'])
+                self.assertIsNone(person['vegetables'])
+            self.assertIsNone(lines[-1]['cursor'])
+
+    def test_export_api_resume(self):
+        """Test export api resumes from a cursor."""
+        app = create_app({'DDB_TABLE': MockScanDynamoResource()})
+        with app.test_client() as client:
+            resp = client.get(self.url, query_string={'segments': 2})
+            lines = self.read_lines(resp)
+            cursor = lines[1]['cursor']
+            self.assertIsNotNone(cursor)
+            resp = client.get(self.url, query_string={'cursor': cursor})
+            self.assertEqual(resp.status_code, 200)
+            resumed = [
+                line['user_id'] for line in self.read_lines(resp)
+                if 'cursor' not in line
+            ]
+            self.assertEqual(len(resumed), 3)
+            self.assertNotIn(lines[0]['user_id'], resumed)
+
+    def test_export_api_table_per_thread(self):
+        """Test export api creates a table once for every scan thread."""
+        app = create_app({'EXPORT_WORKERS': 2})
+        with app.test_client() as client, mock.patch(
+            'app.app.create_table',
+            side_effect=lambda *args: MockScanDynamoResource()
+        ) as mock_create_table:
+            resp = client.get(self.url, query_string={'segments': 3})
+            self.assertEqual(len(self.read_lines(resp)), 12)
+            self.assertLessEqual(mock_create_table.call_count, 2)
+            mock_create_table.assert_called_with(
+                'ap-southeast-2', 'http://dynamodb-local:8000',
+                'PandoraDetails'
+            )
+
+    def wait_idle(self, executor):
+        """Wait until every task submitted to a one thread pool is done."""
+        executor.submit(lambda: None).result(timeout=5)
+
+    def test_export_backpressure_and_disconnect(self):
+        """Test scans pause for a slow client and stop once it leaves."""
+        table = MockEndlessScanDynamoResource()
+        executor = ThreadPoolExecutor(max_workers=1)
+        stream = stream_people(executor, lambda: table, 1, {0: None}, 5)
+        next(stream)
+        self.wait_idle(executor)
+        # One page sent and only the next one read ahead
+        self.assertEqual(table.scans, 2)
+        stream.close()
+        self.wait_idle(executor)
+        self.assertEqual(table.scans, 2)
+        shutdown = threading.Thread(target=executor.shutdown)
+        shutdown.start()
+        shutdown.join(timeout=5)
+        self.assertFalse(shutdown.is_alive())
+
+    def test_export_stalled_client_does_not_block(self):
+        """Test a stalled export leaves the shared pool to other exports."""
+        executor = ThreadPoolExecutor(max_workers=2)
+        stalled = stream_people(
+            executor, MockEndlessScanDynamoResource, 4,
+            dict.fromkeys(range(4)), 5
+        )
+        next(stalled)
+        try:
+            table = MockScanDynamoResource()
+            lines = [
+                json.loads(line)
+                for chunk in stream_people(
+                    executor, lambda: table, 4, dict.fromkeys(range(4)), 5)
+                for line in chunk.splitlines()
+            ]
+            self.assertEqual(len(lines), 16)
+            self.assertIsNone(lines[-1]['cursor'])
+        finally:
+            stalled.close()
+            executor.shutdown()
+
+    def test_export_stopped_page_skips_table(self):
+        """Test pages of a closed export do not create a table."""
+        table_factory = mock.Mock()
+        stop = threading.Event()
+        stop.set()
+        pages = queue.Queue()
+        scan_page(table_factory, 0, 1, None, pages, stop)
+        table_factory.assert_not_called()
+        self.assertTrue(pages.empty())
+
+    def test_export_page_timeout(self):
+        """Test an export ends with an error line when pages stop coming."""
+        executor = ThreadPoolExecutor(max_workers=1)
+        gate = threading.Event()
+        executor.submit(gate.wait)
+        try:
+            lines = list(stream_people(
+                executor, MockScanDynamoResource, 1, {0: None}, 0.1))
+            self.assertEqual(
+                json.loads(lines[-1]), {'Error': 'Export timed out'})
+        finally:
+            gate.set()
+            executor.shutdown()
+
+    def test_export_api_invalid_cursor(self):
+        """Test export api returns error for an invalid cursor."""
+        with create_app().test_client() as client:
+            resp = client.get(self.url, query_string={'cursor': 'asdasd'})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('Error', resp.json)
+
+    def test_export_api_invalid_cursor_start_key(self):
+        """Test export api returns error for a tampered cursor start key."""
+        cursor = encode_cursor(2, {0: 'abc'})
+        with create_app().test_client() as client:
+            resp = client.get(self.url, query_string={'cursor': cursor})
+            self.assertEqual(resp.status_code, 400)
+            self.assertIn('Error', resp.json)
+
+    def test_export_api_invalid_segments(self):
+        """Test export api returns error for out of range segments."""
+        with create_app().test_client() as client:
+            for segments in ('0', '100', 'asd'):
+                resp = client.get(
+                    self.url, query_string={'segments': segments})
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn('Error', resp.json)
+
+    def test_export_api_scan_error(self):
+        """Test export api ends the stream with an error line."""
+        app = create_app({'DDB_TABLE': MockFailingScanDynamoResource()})
+        with app.test_client() as client:
+            resp = client.get(self.url)
+            lines = self.read_lines(resp)
+            self.assertEqual(
+                lines[-1], {'Error': 'Unknown error occured'})
+
+
+class AppFactoryTestCases(TestCase):
+    """Test cases for the application factory."""
+
+    def test_import_defers_heavy_modules(self):
+        """Test importing the app does not import boto3 or pandas."""
+        script = (
+            'import sys; import app.app; '
+            'print(any(m in sys.modules for m in ("boto3", "pandas")))'
+        )
+        output = subprocess.check_output([sys.executable, '-c', script])
+        self.assertEqual(output.strip(), b'False')
+
+    def test_get_table_per_thread(self):
+        """Test every thread gets its own table when none is injected."""
+        tables = []
+
+        def retrieve_tables():
+            with app.app_context():
+                tables.extend([get_table(), get_table()])
+
+        app = create_app({'DYNAMO_TABLE_NAME': 'PerThread'})
+        with mock.patch(
+            'app.app.create_table', side_effect=lambda *args: object()
+        ):
+            for _ in range(2):
+                thread = threading.Thread(target=retrieve_tables)
+                thread.start()
+                thread.join()
+        self.assertIs(tables[0], tables[1])
+        self.assertIsNot(tables[0], tables[2])
+        self.assertIs(tables[2], tables[3])
+
+    def test_create_app_config_from_env(self):
+        """Test PANDORA_ environment variables configure the app."""
+        environ = {
+            'PANDORA_PRELOAD': 'false',
+            'PANDORA_EXPORT_WORKERS': '4',
+            'PANDORA_DYNAMO_TABLE_NAME': 'EnvTable',
+        }
+        with mock.patch.dict('os.environ', environ):
+            app = create_app({'DYNAMO_TABLE_NAME': 'Test'})
+        self.assertIs(app.config['PRELOAD'], False)
+        self.assertEqual(app.config['EXPORT_WORKERS'], 4)
+        self.assertEqual(app.config['DYNAMO_TABLE_NAME'], 'Test')
+
+    def test_create_app_invalid_env(self):
+        """Test invalid environment values are reported."""
+        with mock.patch.dict('os.environ', {'PANDORA_EXPORT_WORKERS': 'x'}):
+            with self.assertRaises(ValueError):
+                create_app()
+
+    def test_create_app_config_override(self):
+        """Test config passed to the factory overrides the defaults."""
+        app = create_app({'DYNAMO_TABLE_NAME': 'Test'})
+        self.assertEqual(app.config['DYNAMO_TABLE_NAME'], 'Test')
+        self.assertEqual(app.config['DYNAMO_REGION'], 'ap-southeast-2')
+        self.assertIsNone(app.config['DDB_TABLE'])
+
+
 if __name__ == '__main__':
     loader = TestLoader()
     suite = loader.loadTestsFromTestCase(CompanyAPITestCases)
     suite.addTests(loader.loadTestsFromTestCase(UserAPITestCases))
+    suite.addTests(loader.loadTestsFromTestCase(ExportAPITestCases))
+    suite.addTests(loader.loadTestsFromTestCase(AppFactoryTestCases))
     TextTestRunner(verbosity=3).run(suite)